@@ -0,0 +1,61 @@
+# vim: tabstop=3:shiftwidth=3:expandtab:autoindent
+
+# Times ansi.parse_ANSI on recorded server output, one line at a time (which is
+# how the proxy calls it.)  Run from the top of the repository:
+#
+#    PYTHONPATH=core python3 bench/ansi_bench.py [trace files...]
+#
+# With no arguments, every bench/traces/*.ansi file is used.  A trace is just
+# raw text as the server sent it, escape codes and all; you can make your own
+# by capturing a session (e.g. with `script' or by logging from a plugin.)
+#
+# Please run this before and after changing the parser -- "optimizations" that
+# look good on paper have a habit of making real traffic slower.
+
+import sys
+import os
+import glob
+import timeit
+
+import ansi
+
+
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
+REPEAT = 5
+
+
+def load_lines(filename):
+   with open(filename, 'r', encoding='utf-8', errors='replace', newline='') as f:
+      return f.read().splitlines(keepends=True)
+
+
+def parse_all(lines):
+   for line in lines:
+      try:
+         ansi.parse_ANSI(line)
+      except ansi.ANSIParsingError:
+         pass
+
+
+def bench(filename):
+   lines = load_lines(filename)
+   n_bytes = sum(len(line) for line in lines)
+
+   timer = timeit.Timer(lambda: parse_all(lines))
+   number, _ = timer.autorange()
+   best = min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+   print("{}: {} lines, {} characters: {:.3f} ms per pass, {:.2f} us/line, {:.1f} MB/s".format(
+      os.path.basename(filename), len(lines), n_bytes,
+      best * 1e3, best * 1e6 / max(len(lines), 1), n_bytes / best / 1e6))
+
+
+if __name__ == '__main__':
+   traces = sys.argv[1:] or sorted(glob.glob(os.path.join(TRACE_DIR, '*.ansi')))
+
+   if len(traces) == 0:
+      print("No traces found in {}".format(TRACE_DIR))
+      exit(1)
+
+   for trace in traces:
+      bench(trace)
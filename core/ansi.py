@@ -1,13 +1,161 @@
 # vim: ts=3:sw=3:expandtab
 
-import copy
+import functools
+import re
+
+from types import MappingProxyType
 
 ANSI_ESC = "\x1B"
 ANSI_ST = "\x1B\\"                                # ST = String Terminator
 
+COLOR_ATTRIBUTES = ('fg', 'bg', 'bold', 'inverse')
+
 class ANSIParsingError(Exception):
    pass
 
+# What each SGR ("Select Graphic Rendition") parameter does, looked up once per
+# parameter instead of walking a long chain of comparisons.  The entries are
+# fully resolved ahead of time:
+#
+#    ('set', attribute, value)  -- set a color attribute
+#    ('xterm256', attribute)    -- start of an extended (38;5;n / 48;5;n) color
+#    ('reset',)                 -- clear every color attribute
+#
+# Codes that aren't in here are ignored.
+_SGR_ACTIONS = {
+   0: ('reset',),
+   1: ('set', 'bold', 1),
+   2: ('set', 'bold', 0),
+   7: ('set', 'inverse', 1),
+   27: ('set', 'inverse', 0),
+   38: ('xterm256', 'fg'),
+   48: ('xterm256', 'bg'),
+}
+
+for _code in range(8):
+   _SGR_ACTIONS[30 + _code] = ('set', 'fg', _code)          # foreground
+   _SGR_ACTIONS[40 + _code] = ('set', 'bg', _code)          # background
+   _SGR_ACTIONS[90 + _code] = ('set', 'fg', _code + 8)      # intense foreground (nonstandard)
+   _SGR_ACTIONS[100 + _code] = ('set', 'bg', _code + 8)     # intense background (nonstandard)
+del _code
+
+# The whole escape-sequence grammar we care about, so that the scanning happens
+# inside the regex engine rather than one character at a time in Python.  Which
+# named group matched (if any) tells parse_ANSI what it found.  (The text in
+# between escapes is found with str.find, which for plain ASCII text hands off
+# to the C library's memchr -- that compares many characters at a time, where
+# the regex engine would go one by one.)
+_ESCAPES = re.compile(r'''
+     \x1b \[ (?P<sgr> [^m]* ) m                # CSI ... m (colors)
+   | \x1b \[ (?P<unbounded> (?=.) )            # CSI with no end in sight
+   | \x1b (?P<string> [X_^\]P] )              # string commands (ignored)
+   | \x1b (?P<reset> c )                       # resets everything
+   | \x1b .?                                   # ... we have no idea (ignored)
+''', re.DOTALL | re.VERBOSE)
+
+# There are only so many combinations of colors a server will actually use, so
+# we keep one dictionary per combination around and hand out that same object
+# every time it comes up.  This way, finding out whether the colors changed is
+# an identity check.  The shared dictionaries are handed out as read-only
+# MappingProxyType views, so nobody can modify one out from under everyone else.
+_COLOR_CACHE = {}
+
+def _canonical_colors(colors):
+   key = (colors.get('fg', -1), colors.get('bg', -1),
+          colors.get('bold', -1), colors.get('inverse', -1))
+
+   canon = _COLOR_CACHE.get(key)
+   if canon is None:
+      canon = _COLOR_CACHE[key] = MappingProxyType(colors)
+
+   return canon
+
+_DEFAULT_COLORS = _canonical_colors({})
+
+@functools.lru_cache(maxsize=1024)
+def _SGR_plan(codes):
+   """Turn the parameters of an SGR sequence (e.g. "0;31") into a tuple of
+   ('set', ...) and ('reset',) actions, with extended colors already resolved.
+
+   Bad parameters come back as a single ('error', message) action, so that
+   they get cached too."""
+
+   if codes.find(":") != -1:
+      return (('error', "Unspported separator (':') found"),)
+
+   try:
+      codes = [int(code) for code in codes.split(';')]
+   except ValueError:
+      return (('error', "Non-numeric SGR parameter in {}".format(repr(codes))),)
+
+   plan = []
+
+   xterm256mode = 0
+   xterm256attr = None
+   for code in codes:
+      if xterm256mode == 1:
+         if code == 5:
+            xterm256mode = 2
+         else:
+            return (('error', "xterm256 color parsing: expected a 5, got {}".format(code)),)
+
+      elif xterm256mode == 2:
+         if code > 255 or code < 0:
+            return (('error', "xterm256 color parsing: color {} is out of bounds".format(code)),)
+
+         plan.append(('set', xterm256attr, code))
+         xterm256mode = 0
+
+      else:
+         action = _SGR_ACTIONS.get(code)
+         if action is None:
+            continue
+
+         if action[0] == 'xterm256':
+            xterm256mode = 1
+            xterm256attr = action[1]
+         else:
+            plan.append(action)
+
+   return tuple(plan)
+
+def _apply_SGR(last_colors, codes):
+   """Work out the (canonical) colors that result from applying the SGR
+   sequence with parameters `codes` (e.g. "0;31") on top of `last_colors`."""
+
+   colors = last_colors.copy()
+
+   # Lots of these sequences don't change anything (servers love sending
+   # redundant resets), so keep track of whether anything actually changed.
+   dirty = False
+
+   for action in _SGR_plan(codes):
+      if action[0] == 'set':
+         if colors.get(action[1]) != action[2]:
+            colors[action[1]] = action[2]
+            dirty = True
+
+      elif action[0] == 'reset':
+         for attr in COLOR_ATTRIBUTES:
+            if attr in colors:
+               del colors[attr]
+               dirty = True
+
+      elif action[0] == 'error':
+         raise ANSIParsingError(action[1])
+
+   if not dirty:
+      return last_colors
+
+   return _canonical_colors(colors)
+
+# Servers tend to use the same few escape codes over and over, so we remember
+# what each one does starting from each set of colors.  (Keyed by the id() of
+# the starting colors, which is safe because canonical color dictionaries are
+# kept alive by _COLOR_CACHE forever.)
+_TRANSITIONS = {}
+_MAX_TRANSITIONS = 4096
+
 def parse_ANSI(text):
     """Decompose a string that contains ANSI color codes into a
     list of the general form
@@ -20,140 +168,120 @@ def parse_ANSI(text):
     containing all the color properties that have been set, which affects
     everything after it until the next dictionary."""
 
-    assert type(text) == str
+    texts, attrs, colored_from_start = _parse_segments(text)
 
-    state = "TEXT"
     acc = []
+    for i in range(len(texts)):
+       # The first segment's colors are only worth mentioning if something
+       # actually set them.
+       if i > 0 or colored_from_start:
+          acc.append(attrs[i])
+       if texts[i] != "":
+          acc.append(texts[i])
 
-    def accumulate_text(text):
-       if len(acc) == 0 or type(acc[-1]) != str:
-          acc.append(text)
-       else:
-          acc[-1] = acc[-1] + text
-
-    cursor = 0
-    last_colors = {}
-
-    while cursor < len(text):
-       character = text[cursor]
-
-       if state == "TEXT":
-          if character == ANSI_ESC:
-             state = "ANSI_ESC"
-          else:
-             # TODO: Grab the whole chunk of text to the next ESC at once
-             accumulate_text(character)
-          cursor += 1
-             
-       elif state == "ANSI_ESC":
-          if character == "[":
-             state = "ANSI_CSI"
-          elif character == "c":      # ( resets everything )
-             acc.append({})
-             state = "TEXT"
-          elif character in ['X', '_', '^', ']', 'P']:
-             state = "ANSI_STRING_COMMAND"
-          else:
-             # ... we have no idea.
-             # TODO: Should we raise an error here or just fail silently?
-             state = "TEXT"
-
-          cursor += 1
-
-       elif state == "ANSI_STRING_COMMAND":
-          # We just ignore all the string commands.
-          endofstr = text[cursor:].find(ANSI_ST) + cursor
-          if endofstr == -1:
-             cursor = len(text)
-          else:
-             cursor = endofstr + len(ANSI_ST)
-
-       elif state == "ANSI_CSI":
-          endofcode = text[cursor:].find('m') + cursor
-          if endofcode == -1:
-             raise ANSIParsingError("Unbounded CSI")
-
-          codes = text[cursor:endofcode]
-
-          if codes.find(":") != -1:
-             raise ANSIParsingError("Unspported separator (':') found")
-
-          colors = copy.copy(last_colors)
+    return acc
 
-          xterm256mode = 0
-          xterm256fg_bg = 0
-          for code in codes.split(';'):
-             code = int(code)
+def parse_ANSI_soa(text):
+    """Like parse_ANSI, but return the chunks as two lists of the same length
+    instead of one mixed list:
 
-             if xterm256mode == 1:
-                if code == 5:
-                   xterm256mode = 2
-                else:
-                   raise ANSIParsingError("xterm256 color parsing: expected a 5, got {}".format(code))
+       (["text with foreground 2", "text with default colors"], [{'fg': 2}, {}])
 
-             elif xterm256mode == 2:
-                if code > 255 or code < 0:
-                   raise ANSIParsingError("xterm256 color parsing: color {} is out of bounds".format(code))
+    attrs[i] holds the color properties that apply to texts[i], so there's no
+    need to check what type each element is.  A segment's text may be empty
+    if the colors changed with nothing left to color (e.g., a reset at the
+    end of a line)."""
 
-                if xterm256fg_bg == 38:
-                   colors['fg'] = code
-                elif xterm256fg_bg == 48:
-                   colors['bg'] = code
-                else:
-                   # Theoretically, this should never be reached ... but there's no reason
-                   # not to cover one's bases.
-                   raise ANSIParsingError("xterm256 color parsing: {} is not 38 or 48".format(xterm256fg_bg))
+    texts, attrs, _ = _parse_segments(text)
+    return (texts, attrs)
 
-                xterm256mode = 0
+def _parse_segments(text):
+    """Does the work for parse_ANSI_soa.  Also returns whether the first
+    segment's colors were given by an escape code (as opposed to being the
+    defaults.)"""
 
-             elif code == 1:
-                colors['bold'] = 1
+    if type(text) is not str:
+       raise TypeError("Expected a str, got {}".format(type(text).__name__))
 
-             elif code == 2:
-                colors['bold'] = 0
+    # Most lines don't have any escape codes in them at all, and checking for
+    # that is a single scan in C.
+    if ANSI_ESC not in text:
+       return ([text], [_DEFAULT_COLORS], False)
 
-             elif code == 7:
-                colors['inverse'] = 1
+    # Text is collected piecewise and only joined into a single string once
+    # the segment ends (at a color change or the end of the input), so long
+    # runs don't get copied over and over again.
+    texts = []
+    attrs = [_DEFAULT_COLORS]
+    parts = []
+    colored_from_start = False
 
-             elif code == 27:
-                colors['inverse'] = 0
+    # (Bound once, so adding text doesn't cost a Python-level call each time.)
+    accumulate_text = parts.append
 
-             elif code >= 30 and code <= 37:
-                # Sets foreground color
-                colors['fg'] = code - 30
+    def start_segment(colors):
+       texts.append("".join(parts))
+       parts.clear()
+       attrs.append(colors)
 
-             elif code >= 40 and code <= 47:
-                # Sets background color
-                colors['bg'] = code - 40
+    last_colors = _DEFAULT_COLORS
 
-             elif code >= 90 and code <= 97:
-                # Sets intense foreground color (nonstandard)
-                colors['fg'] = code - 90 + 8 # see wikipedia and/or old impl.
+    # Local names are quicker to get at than globals and attributes.
+    ESC = ANSI_ESC
+    find = text.find
+    match = _ESCAPES.match
+    transitions = _TRANSITIONS
+    n = len(text)
 
-             elif code >= 100 and code <= 107:
-                # Sets intense background color (nonstandard)
-                colors['bg'] = code - 100 + 8
+    cursor = 0
+    while cursor < n:
+       esc = find(ESC, cursor)
+       if esc == -1:
+          accumulate_text(text[cursor:])
+          break
+       elif esc > cursor:
+          accumulate_text(text[cursor:esc])
+
+       token = match(text, esc)
+       cursor = token.end()
+       kind = token.lastgroup
+
+       if kind == 'sgr':
+          codes = token.group('sgr')
+
+          transition = (id(last_colors), codes)
+          colors = transitions.get(transition)
+          if colors is None:
+             colors = _apply_SGR(last_colors, codes)
+             if len(transitions) < _MAX_TRANSITIONS:
+                transitions[transition] = colors
+
+          if colors is not last_colors:
+             last_colors = colors
+             if len(parts) == 0:
+                # update (no text has been given the old colors)
+                attrs[-1] = colors
+                if len(attrs) == 1:
+                   colored_from_start = True
+             else:
+                start_segment(colors)
 
-             elif code == 38 or code == 48:
-                # Sets an extended xterm256 color
-                xterm256mode = 1
-                xterm256fg_bg = code
+       elif kind == 'reset':
+          start_segment(_DEFAULT_COLORS)
 
-             elif code == 0:
-                # Resets attributes
-                for attr in ['fg', 'bg', 'bold', 'inverse']:
-                   if attr in colors:
-                      del colors[attr]
+       elif kind == 'string':
+          # We just ignore all the string commands.  They can be long, so we
+          # look for the terminator with str.find rather than in the regex.
+          endofstr = find(ANSI_ST, cursor)
+          if endofstr == -1:
+             cursor = n
+          else:
+             cursor = endofstr + len(ANSI_ST)
 
-          if colors != last_colors:
-             last_colors = copy.copy(colors)
-             if len(acc) >= 1 and type(acc[-1]) == dict:
-                # update
-                acc[-1] = colors
-             else:
-                acc.append(colors)
+       elif kind == 'unbounded':
+          raise ANSIParsingError("Unbounded CSI")
 
-          cursor = endofcode + 1
-          state = "TEXT"
+       # (Anything else is an escape we don't know about, and is dropped.)
 
-    return acc
+    texts.append("".join(parts))
+    return (texts, attrs, colored_from_start)
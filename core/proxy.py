@@ -7,7 +7,6 @@
 #    them out
 
 import sys
-import threading
 import logging
 import traceback
 
@@ -16,15 +15,24 @@ import ssl
 import selectors
 
 import json
+import re
 
 import os
+import errno
+import signal
 import hashlib
+import hmac
 import getpass
 import base64
+import codecs
+import collections
 
 import pkgutil
 import importlib
 
+import threading
+import concurrent.futures
+
 import ansi
 
 
@@ -39,7 +47,7 @@ COMMAND_PREFIX = ','
 MESSAGE_PREFIX_OK = '%% '
 MESSAGE_PREFIX_ERR = '!! '
 
-RECV_MAX = 4096 # bytes
+RECV_MAX = 65536 # bytes (enough that a burst of output usually comes in with one recv())
 
 # (defaults; change in config.json)
 BIND_TO_HOST = "localhost"
@@ -100,7 +108,21 @@ class Password:
    When it is initialized, it will try to load the hash from a file; if it can't manage
    to do that, it will block on initialization to prompt the user for a new password
    (and try to persist that to the file.)"""
-   def __init__(self):
+
+   # How many wrong guesses to remember (see verify().)
+   RECENT_FAILURES_MAX = 32
+
+   def __init__(self, hash_method='scrypt'):
+      # Looked up once here, since it can't change while we're running anyway.
+      self.hash_method = hash_method
+
+      # Wrong guesses we've seen lately, as keyed BLAKE2 fingerprints rather than plaintext.
+      # The key is random and only lives as long as the process does.
+      # verify() can be running in more than one thread at once, so the bookkeeping is locked.
+      self.recent_failures = collections.OrderedDict()
+      self.recent_failures_lock = threading.Lock()
+      self.fingerprint_key = os.urandom(32)
+
       self.hashed = load_json(PASSWORD_FILE)
       if self.hashed is None:
          self.prompt_user_for_new_password()
@@ -112,7 +134,7 @@ class Password:
    def hash(self, password, salt):
       """This function should return a bytes-like object containing the hash of 'password'
       given the salt 'salt'.  The password argument should be a string."""
-      hashtype = cfg.get('password_hash_method', 'scrypt')
+      hashtype = self.hash_method
 
       if hashtype == 'scrypt':
          # https://blog.filippo.io/the-scrypt-parameters/ was used for a reference for
@@ -142,10 +164,23 @@ class Password:
       if self.hashed is None:
          raise ValueError("Tried to check a password that doesn't exist.")
 
+      # Someone retrying the same wrong password (or a script hammering away with a list of
+      # them) shouldn't cost us a full scrypt run every time.  We only remember failures, so
+      # nothing cheap to compute ever stands in for the real password.
+      fingerprint = hashlib.blake2b(candidate_password.encode('utf8'), key=self.fingerprint_key).digest()
+      with self.recent_failures_lock:
+         if fingerprint in self.recent_failures:
+            self.recent_failures.move_to_end(fingerprint)
+            return False
+
       candidate = self.hash(candidate_password, self.hashed['salt'])
-      if candidate == self.hashed['hash']:
+      if hmac.compare_digest(candidate, self.hashed['hash']):
          return True
       else:
+         with self.recent_failures_lock:
+            self.recent_failures[fingerprint] = True
+            if len(self.recent_failures) > self.RECENT_FAILURES_MAX:
+               self.recent_failures.popitem(last=False)
          return False
 
 
@@ -154,9 +189,25 @@ class Password:
 ###
 
 
+def describe_undecodable_bytes(error):
+   """Codec error handler (see codecs.register_error) that replaces each byte that couldn't be
+   decoded with '?(<byte value>)', so that the decoder can carry on in one pass."""
+   bad = error.object[error.start:error.end]
+   return (''.join('?(' + str(byte) + ')' for byte in bad), error.end)
+
+UNDECODABLE_BYTES = 'tcphydra-describe'
+codecs.register_error(UNDECODABLE_BYTES, describe_undecodable_bytes)
+
+
 class TextLine:
    """An abstract container for lines of text.  This seemed like an important
    design element at one point, but it may not be nearly as important now."""
+
+   # One of these is made for every line that goes through the proxy, so they're kept small
+   # and quick to make.  (Reusing them instead isn't an option: filters are free to hang on
+   # to lines -- the scrollback plugin keeps the last however-many around, for example.)
+   __slots__ = ('__raw', '__enc', '__str')
+
    def __init__(self, string, encoding):
       assert type(string) == bytes or type(string) == str
       self.__enc = encoding
@@ -170,28 +221,78 @@ class TextLine:
       else:
          self.__raw = string.encode(self.__enc)
 
+      self.__str = None
+
    def as_str(self):
       """Try to 'safely', but lossily, decode the raw line into an ordinary string,
-      according to the encoding given."""
-      s = ""
-      r = self.__raw
+      according to the encoding given.  Bytes that can't be decoded show up as
+      '?(<byte value>)'."""
+      # A line tends to get looked at by several filters and then the proxy itself, so the
+      # decoded version is kept around until the line is changed.
+      if self.__str is None:
+         self.__str = self.__raw.decode(self.__enc, errors=UNDECODABLE_BYTES)
+      return self.__str
 
-      while len(r) > 0:
-         try:
-            s += r.decode(self.__enc)
-            r = ''
-         except UnicodeDecodeError as e:
-            s += r[:e.start].decode(self.__enc)
+   def as_bytes(self):
+      return self.__raw
 
-            for byte in r[e.start:e.end]:
-               s += '?(' + str(byte) + ')'
 
-            r = r[e.end:]
+TELNET_IAC = 255
+TELNET_DONT = 254
+TELNET_DO = 253
+TELNET_WONT = 252
+TELNET_WILL = 251
 
-      return s
 
-   def as_bytes(self):
-      return self.__raw
+# One telnet command, starting at an IAC.  Which group matched (if any) says what to do with it:
+#
+#    IAC IAC                       -- an escaped 255 byte, which is kept
+#    IAC <DO/DONT/WILL/WONT> opt   -- option negotiation (3 bytes, dropped)
+#    IAC anything else             -- some other command (2 bytes, dropped)
+#
+# A command cut off by the end of the data doesn't match at all.
+_TELNET_COMMAND = re.compile(rb'''
+     \xff (?P<escaped> \xff )
+   | \xff [\xfb-\xfe] .
+   | \xff [^\xfb-\xff]
+''', re.DOTALL | re.VERBOSE)
+
+
+def strip_telnet(data):
+   """Remove telnet commands (IAC ...) from the bytes `data', turning IAC IAC back into a single
+   255 byte.  Returns a pair like `(stripped data, leftover)'; if `data' ends partway through a
+   command, the start of that command is returned as `leftover' so it can be put in front of
+   whatever arrives next.
+
+   The stripped data is returned as a bytearray.  Runs of ordinary data are found with
+   bytes.find and copied in one go, so this costs next to nothing for the (very common) case
+   where there are no commands at all; the commands themselves are picked apart by a regex
+   (see _TELNET_COMMAND.)"""
+   view = memoryview(data)
+   stripped = bytearray()
+   cursor = 0
+
+   find = data.find
+   match = _TELNET_COMMAND.match
+
+   while True:
+      iac = find(TELNET_IAC, cursor)
+      if iac == -1:
+         stripped += view[cursor:]
+         return (stripped, b'')
+
+      stripped += view[cursor:iac]
+
+      command = match(data, iac)
+      if command is None:
+         return (stripped, bytes(view[iac:]))
+
+      if command.lastgroup == 'escaped':
+         stripped.append(TELNET_IAC)
+
+      # TODO: Figure out if there are Telnet codes that will be baffled by this
+      # (are they all guaranteed to be 2 bytes long except for IAC <DODONTWILLWONT> XYZ?)
+      cursor = command.end()
 
 
 class LineBufferingSocketContainer:
@@ -200,8 +301,16 @@ class LineBufferingSocketContainer:
    (Thus this class only works with servers that are willing to play dumb.  But
    that's most servers, luckily for us.)"""
    def __init__(self, socket = None):
-      self.__b_send_buffer = b''
-      self.__b_recv_buffer = b''
+      # (bytearrays, so that adding to and taking from them happens in place rather than
+      # copying the whole buffer every time.)
+      self.__b_send_buffer = bytearray()
+      self.__b_recv_buffer = bytearray()
+      self.__b_telnet_pending = b''
+
+      # The socket reads into this (reused) buffer, which saves making a new bytes object
+      # for every recv() call.
+      self.__b_recv_scratch = bytearray(RECV_MAX)
+      self.__b_recv_scratch_view = memoryview(self.__b_recv_scratch)
 
       self.connected = False
 
@@ -210,6 +319,10 @@ class LineBufferingSocketContainer:
       self.encoding = ENCODING
       self.linesep = LINE_SEPARATOR
 
+      # Whether to ask for incoming data to be acknowledged right away after every read
+      # (Linux only; see Proxy.__init__.)
+      self.quickack = False
+
       if socket != None:
          self.attach_socket(socket)
 
@@ -217,7 +330,7 @@ class LineBufferingSocketContainer:
       """Write a string to the underlying socket."""
       assert type(data) == str
 
-      self.__b_send_buffer += data.encode(self.encoding)
+      self.__b_send_buffer.extend(data.encode(self.encoding))
 
       self.flush()
 
@@ -225,7 +338,7 @@ class LineBufferingSocketContainer:
       """Write a TextLine to the underlying socket."""
       assert type(line) == TextLine
 
-      self.__b_send_buffer += line.as_bytes()
+      self.__b_send_buffer.extend(line.as_bytes())
 
       self.flush()
 
@@ -233,29 +346,44 @@ class LineBufferingSocketContainer:
       """Write some bytes to the underlying socket."""
       assert type(data) == bytes
 
-      self.__b_send_buffer += data
+      self.__b_send_buffer.extend(data)
 
       self.flush()
 
+   def queue(self, data):
+      """Add some bytes to the send buffer without trying to send them yet; the proxy flushes
+      every socket once per trip around the main loop."""
+      self.__b_send_buffer.extend(data)
+
    def flush(self):
       """Send as much buffered input as the socket will allow, but only attempt to
-      do so up to the end of the last complete line."""
+      do so up to the end of the last complete line.  Returns False if the socket
+      couldn't take it all right now (so it's worth trying again once it can.)"""
       assert self.socket != None
       assert self.connected
 
-      while len(self.__b_send_buffer) > 0 and self.linesep in self.__b_send_buffer:
-         try:
-            t = self.__b_send_buffer.index(self.linesep)
-            n_bytes = self.socket.send(self.__b_send_buffer[:t+1])
-            self.__b_send_buffer = self.__b_send_buffer[n_bytes:]
+      # Everything up to the end of the last complete line goes out together, rather than
+      # one send() per line.  (SSL sockets only take so much per call, hence the loop.)
+      end = self.__b_send_buffer.rfind(self.linesep) + 1
+      sent = 0
+      blocked = False
 
-         except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
-            logging.info("Note: BlockingIOError in flush() call")
-            break
+      with memoryview(self.__b_send_buffer) as view:
+         while sent < end:
+            try:
+               sent += self.socket.send(view[sent:end])
 
-         except OSError:
-            logging.error("Got an OSError in flush() call")
-            break
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+               logging.info("Note: BlockingIOError in flush() call")
+               blocked = True
+               break
+
+            except OSError:
+               logging.error("Got an OSError in flush() call")
+               break
+
+      del self.__b_send_buffer[:sent]
+      return not blocked
 
    def read(self):
       """Read as much data as the socket will provide.  Returns a pair like `([list of TextLine's or empty],
@@ -265,83 +393,64 @@ class LineBufferingSocketContainer:
 
       has_eof = False
 
+      received = bytearray()
+
       try:
-         data = b''
          while True:
-            data = self.socket.recv(RECV_MAX)
-            self.__b_recv_buffer += data
-            if len(data) < RECV_MAX:
+            n_bytes = self.socket.recv_into(self.__b_recv_scratch)
+            received.extend(self.__b_recv_scratch_view[:n_bytes])
+            if n_bytes < RECV_MAX:
                # If the length of data returned by a read() call is 0, that actually means the
                # remote side closed the connection.  If there's actually no data to be read,
                # you get a BlockingIOError or one of its SSL-based cousins instead.
-               if len(data) == 0:
+               if n_bytes == 0:
                   has_eof = True
                break
-            data = b''
 
       except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
          pass
 
+      except ConnectionResetError:
+         has_eof = True
+
       except OSError:
          logging.error("Got an OSError in read() call")
 
-      except ConnectionResetError:
-         has_eof = True
+      # (The kernel turns quick acknowledgements back off by itself, hence doing this every time.)
+      if self.quickack and not has_eof:
+         try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+         except OSError:
+            pass
 
       q = []
 
       # Telnet codes are a problem.  TODO: Improve this super hacky solution, which just involves
       # ... completely removing them from the input stream (except for IAC IAC / 255 255.)
+      #
+      # If the read() call left us in the middle of a command, which I don't think is *likely*
+      # but could happen, the start of it is kept aside and tacked onto the front of the next
+      # batch of data.
 
-      stripped = b''
-
-      IAC = 255
-      DONT = 254
-      DO = 253
-      WONT = 252
-      WILL = 251
-
-      in_command = False
-
-      # Speaking of awful hacks, this is probably not very efficient at all:
-
-      x = 0
-      while x < len(self.__b_recv_buffer):
-         if in_command:
-            if self.__b_recv_buffer[x] == IAC:
-               stripped += bytes([IAC])
-               in_command = False
-            elif self.__b_recv_buffer[x] <= DONT and self.__b_recv_buffer[x] >= WILL:
-               pass
-            else:
-               # TODO: Figure out if there are Telnet codes that will be baffled by this
-               # (are they all guaranteed to be 2 bytes long except for IAC <DODONTWILLWONT> XYZ?)
-               in_command = False
-         else:
-            if self.__b_recv_buffer[x] == IAC:
-               in_command = True
-            else:
-               stripped += self.__b_recv_buffer[x:x+1]
-         x += 1
+      if len(self.__b_telnet_pending) > 0:
+         received[:0] = self.__b_telnet_pending
+      stripped, self.__b_telnet_pending = strip_telnet(received)
+      self.__b_recv_buffer.extend(stripped)
 
       # The best we can do for a record separator in this case is a byte or byte sequence that
       # means 'newline'. We go with one byte for now for simplicity & because it works with
       # UTF-8/ASCII at least, which comprises most things we're interested in.
 
-      while self.linesep in stripped:
-         t = stripped.index(self.linesep)
-         q += [TextLine(stripped[:t+1], self.encoding)]
-         stripped = stripped[t+1:]
-
-      self.__b_recv_buffer = stripped
-
-      # Make sure it starts in in_command mode again next time around in case the read() call
-      # left us in the middle of a command, which I don't think is *likely* but could happen.
-      # (The rest of the command will get tacked on after the IAC, which will ensure
-      # the thing goes back into command mode immediately prior.)
+      start = 0
+      with memoryview(self.__b_recv_buffer) as view:
+         while True:
+            t = self.__b_recv_buffer.find(self.linesep, start)
+            if t == -1:
+               break
+            q += [TextLine(bytes(view[start:t+1]), self.encoding)]
+            start = t + 1
 
-      if in_command:
-         self.__b_send_buffer += bytes([IAC])
+      del self.__b_recv_buffer[:start]
 
       return (q, has_eof)
 
@@ -375,6 +484,7 @@ class FilteredSocket(LineBufferingSocketContainer):
    def __init__(self):
       super().__init__()
       self.filters = []
+      self.state = None    # which of Proxy.handlers gets our lines ('server', 'auth' or 'client')
 
    def add_filters(self, filters, prototypes):
       """Add filters to self according to the specification in `filters` (same format as
@@ -413,15 +523,17 @@ class RemoteServer(FilteredSocket):
       self.port = port
       self.name = name
 
-      self.subscribers = []
+      self.subscribers = set()
 
-      self.connecting_in_thread = False
+      self.connecting = False
       self.use_SSL = False
+      self.nodelay = True
 
    def handle_data(self, data):
       """Called when some data has arrived and needs to be dispatched to the subscribers."""
+      b = data.as_bytes()
       for sub in self.subscribers:
-         sub.write_line(data)
+         sub.queue(b)
 
    def attach_socket(self, socket):
       """Set up to use socket `socket'.  Overridden to notify any filters when a server is connected."""
@@ -432,6 +544,11 @@ class RemoteServer(FilteredSocket):
             f.server_connect(True)
          except AttributeError:
             pass
+         except Exception:
+            # (A broken filter shouldn't take the connection -- or the proxy -- down with it.)
+            kind, value, t = sys.exc_info()
+            logging.error("Error telling a server filter about the connection: {}".format(repr(value)))
+            logging.error(traceback.format_exc())
 
    def handle_disconnect(self):
       """Called when the connection has been lost."""
@@ -444,18 +561,21 @@ class RemoteServer(FilteredSocket):
             f.server_connect(False)
          except AttributeError:
             pass
+         except Exception:
+            # (See attach_socket().)
+            kind, value, t = sys.exc_info()
+            logging.error("Error telling a server filter about the disconnection: {}".format(repr(value)))
+            logging.error(traceback.format_exc())
 
    def subscribe(self, supplicant):
       """Add `supplicant' to the list of subscribed clients."""
       assert type(supplicant) == LocalClient
-      if supplicant not in self.subscribers:
-         self.subscribers.append(supplicant)
+      self.subscribers.add(supplicant)
 
    def unsubscribe(self, supplicant):
       """Remove `supplicant' from the list of subscribed clients."""
       assert type(supplicant) == LocalClient
-      while supplicant in self.subscribers:
-         self.subscribers.remove(supplicant)
+      self.subscribers.discard(supplicant)
 
    def tell_all(self, msg):
       """Tell all the clients subscribed to this particular server of something."""
@@ -527,6 +647,17 @@ class LocalClient(FilteredSocket):
             pass
 
 
+def connection_failure_message(err):
+   """What to tell clients when a connection attempt failed because of `err'."""
+   if isinstance(err, ConnectionRefusedError):
+      return "Connection attempt failed: Connection refused"
+   elif isinstance(err, OSError):
+      return "Connection attempt failed, network error: {}".format(repr(err))
+   else:
+      logging.error("NON-SOCKET CONNECTION ERROR: {}".format(repr(err)))
+      return "Connection attempt failed, other error: {}".format(repr(err))
+
+
 ###
 ### PROXY
 ###
@@ -534,9 +665,9 @@ class LocalClient(FilteredSocket):
 
 class Proxy:
    def __init__(self, cfg):
-      self.LOCK = threading.Lock()
       self.sel = selectors.DefaultSelector()
       self.socket_wrappers = {}
+      self.waiting_to_send = set()  # sockets with output they couldn't take yet (see drain_all())
 
       self.tls_ctx_remote = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
       self.tls_ctx_local  = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
@@ -547,17 +678,51 @@ class Proxy:
       self.tls_ctx_local.load_cert_chain("ssl/cert.pem")
 
       self.servers = {}             # index of available servers by display name
-      self.server_sockets = []
+      self.server_sockets = set()
+      self.pending_lookups = {}     # Future (of a getaddrinfo() call) -> RemoteServer
+      self.pending_connections = {} # outbound sockets still connecting -> (RemoteServer, [addresses left to try])
 
-      self.client_sockets = []
+      self.client_sockets = set()
       self.client_commands = {}
-
-      self.unauthenticated_sockets = []
-      self.password = Password()
-
-      self.states = [(self.server_sockets, self.handle_line_server),
-                     (self.unauthenticated_sockets, self.handle_line_auth),
-                     (self.client_sockets, self.handle_line_client)]
+      self.help_index = {}          # command function -> [all the names it goes by]
+      self.help_lines = None        # what ,help says (made on first use)
+      self.command_prefix_b = COMMAND_PREFIX.encode(ENCODING)
+
+      self.unauthenticated_sockets = set()
+      self.password = Password(cfg.get('password_hash_method', 'scrypt'))
+      self.warn_about_connections = cfg.get("warn_about_connections", True)
+
+      # Optional socket tuning.  so_rcvbuf and so_sndbuf set the kernel's buffer sizes (in bytes)
+      # for every connection, instead of leaving them up to the OS (which is also what null
+      # means); tcp_quickack turns off delayed acknowledgements, where the OS has them (i.e. Linux.)
+      self.socket_buffer_options = []
+      if cfg.get('so_rcvbuf') is not None:
+         self.socket_buffer_options.append((socket.SO_RCVBUF, int(cfg['so_rcvbuf'])))
+      if cfg.get('so_sndbuf') is not None:
+         self.socket_buffer_options.append((socket.SO_SNDBUF, int(cfg['so_sndbuf'])))
+
+      self.tcp_quickack = bool(cfg.get('tcp_quickack', False))
+      if self.tcp_quickack and not hasattr(socket, 'TCP_QUICKACK'):
+         logging.warning("tcp_quickack isn't supported on this platform; ignoring it")
+         self.tcp_quickack = False
+
+      # Checking a password is slow on purpose (that's what scrypt is for), and looking up a
+      # server's address can be slow by accident, so both are done in other threads instead of
+      # holding up everybody else.  When one is done, a byte is sent through the wakeup socket
+      # pair so the main loop notices.  Each kind gets its own thread, so that a lookup is never
+      # stuck behind however many password checks are waiting (and the checks, which are
+      # expensive on purpose, still only happen one at a time.)
+      self.kdf_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+      self.lookup_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+      self.pending_auth = {}        # socket -> (Future, [lines that arrived in the meantime])
+      self.wakeup_r, self.wakeup_w = socket.socketpair()
+      self.wakeup_r.setblocking(False)
+      self.wakeup_w.setblocking(False)
+      self.sel.register(self.wakeup_r, selectors.EVENT_READ)
+
+      self.handlers = {'server': self.handle_line_server,
+                       'auth': self.handle_line_auth,
+                       'client': self.handle_line_client}
 
       if cfg.get('debug', False):
          self.register_command("e", self.do_client_debug)
@@ -583,6 +748,11 @@ class Proxy:
       #assert type(cmd) == function
       if cmdname not in self.client_commands:
          self.client_commands[cmdname] = cmd
+
+         # Commands can have multiple names, so they're also kept by the function they call,
+         # so that help doesn't end up displaying the same bit of help many times.
+         self.help_index.setdefault(cmd, []).append(cmdname)
+         self.help_lines = None
       else:
          logging.warning("Note: Attempt to overwrite command `{}' failed".format(cmdname))
 
@@ -595,6 +765,31 @@ class Proxy:
       else:
          logging.warning("Note: Attempted to overwrite filter type `{}' failed".format(name))
 
+   def set_buffer_sizes(self, sock):
+      """Apply the configured socket buffer sizes (if any) to `sock'.  Best done before the
+      socket is connected (or listening), since that's when the TCP window gets worked out."""
+      for option, size in self.socket_buffer_options:
+         try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+         except OSError as e:
+            logging.warning("Couldn't set socket buffer size to {}: {}".format(size, e))
+
+   def drain_all(self):
+      """Send whatever's been queued up for every connected socket.  Sockets that can't take
+      all of it right away are watched for writability until they can, so the rest goes out
+      as soon as possible rather than whenever something else wakes the main loop up."""
+      for s, wrapper in self.socket_wrappers.items():
+         if not wrapper.connected:
+            continue
+
+         if wrapper.flush():
+            if s in self.waiting_to_send:
+               self.waiting_to_send.discard(s)
+               self.sel.modify(s, selectors.EVENT_READ)
+         elif s not in self.waiting_to_send:
+            self.waiting_to_send.add(s)
+            self.sel.modify(s, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
    def wall(self, mesg):
       """Warn every client with the string `mesg'."""
       for socket in self.client_sockets:
@@ -604,13 +799,17 @@ class Proxy:
          c = self.socket_wrappers[socket]
          c.tell_err(mesg)
 
+   def handle_line(self, s, line):
+      """Pass a line that came in on socket `s' to whichever state it's in."""
+      wrapper = self.socket_wrappers.get(s)
+      if wrapper is not None:
+         self.handlers[wrapper.state](s, line)
+
    ###
    ### STATE: server
    ###
 
    def handle_line_server(self, socket, line):
-      assert socket in self.server_sockets
-
       svr = self.socket_wrappers[socket]
       ln = line
 
@@ -625,101 +824,225 @@ class Proxy:
          if ln is None:
             return
 
-      self.socket_wrappers[socket].handle_data(ln)
-      return False # don't continue trying states
+      svr.handle_data(ln)
+
+   def start_connection(self, server):
+      """Start connecting to `server' (unless it's connected or on its way.)  Returns whether an
+      attempt was started."""
+      assert type(server) == RemoteServer
+
+      if server.connecting or server.connected:
+         return False
 
-   def do_start_connection(self, server):
       logging.info("Starting to connect to server {}:{}.".format(server.host, server.port))
 
-      # This will always be ran in a thread -- to prevent long-blocking connection
+      # The connection is made without blocking, to prevent long-blocking connection
       # attempts from hanging the whole program (e.g., when a server is down,
       # tinyfugue can spend quite a while waiting for a connection attempt to
-      # come through...)
+      # come through...)  First the address is looked up in a worker thread (see
+      # finish_lookups()); then each address it has is tried in turn, with the selector
+      # telling us when a socket is ready to go on and continue_connection() taking it
+      # from there.
+      server.connecting = True
 
-      # The main program will set connecting_in_thread synchronously *before*
-      # calling this thread, so we don't need to worry about accidental multiple
-      # connection attempts.
+      future = self.lookup_pool.submit(socket.getaddrinfo, server.host, server.port, type=socket.SOCK_STREAM)
+      self.pending_lookups[future] = server
+      future.add_done_callback(self.wake_up)
+      return True
 
-      # It would probably be better to try to figure out asynchronous connect() or
-      # something eventually.
+   def finish_lookups(self):
+      """Start connecting to every server whose address lookup has finished."""
+      for future, server in list(self.pending_lookups.items()):
+         if not future.done():
+            continue
 
-      try:
-         assert type(server) == RemoteServer
-         assert server.socket == None
-         assert not server.connected
+         del self.pending_lookups[future]
+
+         try:
+            addresses = future.result()
+         except Exception as err:
+            # (Not just network errors: a bad host name in the configuration can make
+            # getaddrinfo() raise all sorts of things.)
+            server.connecting = False
+            server.warn_all(connection_failure_message(err))
+            continue
+
+         self.try_addresses(server, addresses)
+
+   def try_addresses(self, server, addresses, err=None):
+      """Start a connection to `server' at the first of `addresses' (as from getaddrinfo())
+      that'll take one, the way socket.create_connection() would.  If there aren't any left,
+      give up and tell everyone why (`err' being what went wrong with the last one.)"""
+      while len(addresses) > 0:
+         family, kind, proto, _, address = addresses.pop(0)
+         C = None
 
-         rlock = False
+         try:
+            C = socket.socket(family, kind, proto)
+            C.setblocking(False)
+
+            # Lines are small and somebody's waiting on each one, so don't let Nagle's algorithm
+            # sit on them hoping for more.
+            if server.nodelay:
+               C.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.set_buffer_sizes(C)
+
+            e = C.connect_ex(address)
+            if e not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+               raise OSError(e, os.strerror(e))
+
+         except Exception as e:
+            # (e.g., a port number that's out of range raises OverflowError.)
+            if C is not None:
+               C.close()
+            err = e
+            continue
+
+         self.pending_connections[C] = (server, addresses)
+         self.sel.register(C, selectors.EVENT_WRITE)
+         return
 
-         C = socket.create_connection((server.host, server.port))
+      server.connecting = False
+      server.warn_all(connection_failure_message(err))
+
+   def continue_connection(self, C):
+      """Called when the selector says a socket in `pending_connections' is ready; carries on
+      connecting (or doing the SSL handshake) and hands the socket over to its server once
+      that's done."""
+      server, addresses = self.pending_connections[C]
+
+      if not isinstance(C, ssl.SSLSocket):
+         # The connect() call has finished one way or the other.  If it didn't work, move on
+         # to the next address (if there is one.)
+         err = C.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+         if err != 0:
+            del self.pending_connections[C]
+            self.sel.unregister(C)
+            C.close()
+            self.try_addresses(server, addresses, OSError(err, os.strerror(err)))
+            return
 
-         if server.use_SSL:
-            C = self.tls_ctx_remote.wrap_socket(C)
+      try:
+         if not isinstance(C, ssl.SSLSocket):
+            if server.use_SSL:
+               del self.pending_connections[C]
+               self.sel.unregister(C)
 
-         self.LOCK.acquire()
-         rlock = True
+               C = self.tls_ctx_remote.wrap_socket(C, do_handshake_on_connect=False,
+                                                   server_hostname=server.host)
 
-         server.attach_socket(C)
-         self.socket_wrappers[C] = server
-         self.server_sockets += [C]
-         self.sel.register(C, selectors.EVENT_READ)
+               self.pending_connections[C] = (server, addresses)
+               self.sel.register(C, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+         if isinstance(C, ssl.SSLSocket):
+            try:
+               C.do_handshake()
+            except ssl.SSLWantReadError:
+               self.sel.modify(C, selectors.EVENT_READ)
+               return
+            except ssl.SSLWantWriteError:
+               self.sel.modify(C, selectors.EVENT_WRITE)
+               return
 
       except ConnectionRefusedError:
-         server.warn_all("Connection attempt failed: Connection refused")
+         self.abandon_connection(C, "Connection attempt failed: Connection refused")
+         return
 
       except ssl.SSLError as e:
-         server.warn_all("Connection attempt failed, SSL error: {}", repr(e))
+         self.abandon_connection(C, "Connection attempt failed, SSL error: {}".format(repr(e)))
+         return
 
       except (socket.error, socket.herror, socket.gaierror, socket.timeout) as err:
-         server.warn_all("Connection attempt failed, network error: {}".format(repr(err)))
-
-      except OSError as err:
-         server.warn_all("Connection attempt failed, OSError: {}".format(repr(err)))
+         self.abandon_connection(C, "Connection attempt failed, network error: {}".format(repr(err)))
+         return
 
       except Exception:
          kind, value, t = sys.exc_info()
-         server.warn_all("Connection attempt failed, other error: {}".format(repr(value)))
+         self.abandon_connection(C, "Connection attempt failed, other error: {}".format(repr(value)))
          logging.error("NON-SOCKET CONNECTION ERROR\n===========================\n\n" + traceback.format_exc())
+         return
 
-      finally:
-         server.connecting_in_thread = False
-         if rlock:
-            self.LOCK.release()
+      try:
+         server.attach_socket(C)
+      except Exception:
+         kind, value, t = sys.exc_info()
+         self.abandon_connection(C, "Connection attempt failed, other error: {}".format(repr(value)))
+         logging.error("NON-SOCKET CONNECTION ERROR\n===========================\n\n" + traceback.format_exc())
          return
 
-   def start_connection(self, server):
-      assert type(server) == RemoteServer
+      del self.pending_connections[C]
+      self.sel.modify(C, selectors.EVENT_READ)
 
-      if not server.connecting_in_thread and not server.connected:
-         server.connecting_in_thread = True
-         t_connect = threading.Thread(target = self.do_start_connection, args = [server])
-         t_connect.start()
-         return True
-      else:
-         return False
+      server.connecting = False
+      self.socket_wrappers[C] = server
+      self.server_sockets.add(C)
+      server.state = 'server'
+
+   def abandon_connection(self, C, msg):
+      """Give up on the pending connection `C' and tell everyone listening to its server why."""
+      server, _ = self.pending_connections.pop(C)
+      self.sel.unregister(C)
+      C.close()
+
+      server.connecting = False
+      server.warn_all(msg)
 
    ###
    ### STATE: unauthenticated client
    ###
 
    def handle_line_auth(self, socket, line):
-      assert socket in self.unauthenticated_sockets
+      if socket in self.pending_auth:
+         # We're still checking an earlier attempt; this line will be dealt with once that's
+         # done (it might be the next attempt, or the first thing an authorized client says.)
+         self.pending_auth[socket][1].append(line)
+         return
 
       s = line.as_str().replace('\r\n', '').replace('\n', '')
 
-      if self.password.verify(s):
-         if cfg.get("warn_about_connections", True):
-            self.wall("A client has authorized itself.")
+      future = self.kdf_pool.submit(self.password.verify, s)
+      self.pending_auth[socket] = (future, [])
+      future.add_done_callback(self.wake_up)
 
-         while socket in self.unauthenticated_sockets:
-            self.unauthenticated_sockets.remove(socket)
+   def wake_up(self, *args):
+      """Make the main loop's select() call return.  Can be called from any thread."""
+      try:
+         self.wakeup_w.send(b'\0')
+      except BlockingIOError:
+         pass # (... it's already got plenty of reasons to wake up.)
 
-         self.client_sockets.append(socket)
+   def finish_authentication(self):
+      """Let in (or turn away) every client whose password check has finished."""
+      for s, (future, queued) in list(self.pending_auth.items()):
+         if not future.done():
+            continue
 
-      else:
-         c = self.socket_wrappers[socket]
-         c.tell_err("Incorrect.")
+         del self.pending_auth[s]
+
+         if s not in self.unauthenticated_sockets:
+            continue # (they left while we were checking)
+
+         try:
+            correct = future.result()
+         except Exception:
+            kind, value, t = sys.exc_info()
+            logging.error("Error checking password: {}".format(repr(value)))
+            correct = False
 
-      return True # stop the main loop from going on to state n+1
+         if correct:
+            if self.warn_about_connections:
+               self.wall("A client has authorized itself.")
+
+            self.unauthenticated_sockets.discard(s)
+            self.client_sockets.add(s)
+            self.socket_wrappers[s].state = 'client'
+
+         else:
+            c = self.socket_wrappers[s]
+            c.tell_err("Incorrect.")
+
+         for line in queued:
+            self.handle_line(s, line)
 
 
    ###
@@ -727,8 +1050,6 @@ class Proxy:
    ###
 
    def handle_line_client(self, socket, line):
-      assert socket in self.client_sockets
-
       c = self.socket_wrappers[socket]
 
       ln = line
@@ -743,15 +1064,19 @@ class Proxy:
          if ln is None:
             return
 
-      s = line.as_str().replace('\r\n', '').replace('\n', '')
+      # Only commands need to be decoded at all; everything else goes on to the server as-is.
+      raw = ln.as_bytes()
 
-      if s[:len(COMMAND_PREFIX)] == COMMAND_PREFIX:
+      if raw.startswith(self.command_prefix_b):
          try:
-            if ' ' in s:
-               cmd = s[len(COMMAND_PREFIX):s.index(' ')]
-               args = s[s.index(' ')+1:]
+            raw = raw.rstrip(b'\r\n')
+
+            sp = raw.find(b' ', len(self.command_prefix_b))
+            if sp != -1:
+               cmd = raw[len(self.command_prefix_b):sp].decode(c.encoding, errors=UNDECODABLE_BYTES)
+               args = raw[sp+1:].decode(c.encoding, errors=UNDECODABLE_BYTES)
             else:
-               cmd = s[len(COMMAND_PREFIX):]
+               cmd = raw[len(self.command_prefix_b):].decode(c.encoding, errors=UNDECODABLE_BYTES)
                args = ''
 
             if cmd in self.client_commands:
@@ -765,9 +1090,7 @@ class Proxy:
             logging.error("COMMAND PROCESSING ERROR\n========================\n\n" + traceback.format_exc())
 
       else:
-         c.handle_data(line)
-
-      return False # don't continue trying states
+         c.handle_data(ln)
 
    def do_client_join(self, args, client):
       """Start listening to a server."""
@@ -818,19 +1141,12 @@ class Proxy:
       """Get help."""
       assert type(client) == LocalClient
 
-      # Commands can have multiple names, so we collect them in a dictionary ordered by
-      # the function they call so that we don't end up displaying the same bit of help
-      # many times.
-      cmds = {}
-
-      for cmd, fn in self.client_commands.items(): # (k, v)
-         if fn in cmds:
-            cmds[fn].append(cmd)
-         else:
-            cmds[fn] = [cmd]
+      if self.help_lines is None:
+         self.help_lines = ["{}: {}".format(', '.join(names), fn.__doc__ or "No documentation provided.")
+                            for fn, names in self.help_index.items()] # (k, v)
 
-      for fn, names in cmds.items(): # (k, v)
-         client.tell_ok("{}: {}".format(', '.join(names), fn.__doc__ or "No documentation provided."))
+      for line in self.help_lines:
+         client.tell_ok(line)
 
    def do_client_stop_everything(self, args, client):
       """Stop the proxy."""
@@ -850,6 +1166,9 @@ class Proxy:
             self.servers[name].encoding = proto['encoding']
          if 'ssl' in proto and proto['ssl'] is True:
             self.servers[name].use_SSL = True
+         if 'nodelay' in proto:
+            self.servers[name].nodelay = bool(proto['nodelay'])
+         self.servers[name].quickack = self.tcp_quickack
 
          server_filters = self.cfg.get('filter_servers', [])
          try:
@@ -859,40 +1178,55 @@ class Proxy:
             logging.error("Error while setting up filters: {}".format(str(e)))
 
       client_filters = self.cfg.get('filter_clients', [])
+      client_nodelay = self.cfg.get('nodelay', True)
 
       try:
-         def do_accept(socket, mask):
-            logging.info("Accepting new client...")
-
-            # When SSL is turned on, this can block waiting for the client to send an SSL handshake.
-            # Maybe consider running it in a thread, too?  (That's a lot of threading though.  And
-            # clients are more under our control than remote servers are.)
-            try:
-               connection, address = socket.accept() # and hope it works
-            except ssl.SSLError as e:
-               logging.error("SSL error in do_accept(): {}".format(e))
-               return
-            except Exception:
-               kind, val, traceback = sys.exc_info()
-               logging.error("Error in do_accept(): {}".format(val))
-               return
-
-            logging.info("Accepted {} from {} (mask={}).".format(repr(connection), repr(address), repr(mask)))
-
-            if cfg.get("warn_about_connections", True):
-               self.wall("A client has connected from {}.".format(repr(address)))
-
-            self.socket_wrappers[connection] = LocalClient(connection)
-            self.unauthenticated_sockets += [connection]
-            self.sel.register(connection, selectors.EVENT_READ)
-
-            try:
-               self.socket_wrappers[connection].add_filters(client_filters, self.filter_prototypes)
-            except FilterSpecificationError as e:
-               self.socket_wrappers[connection].tell_err("Error setting up client filters: {}".format(str(e)))
+         def do_accept(listener, mask):
+            # Take every client that's waiting to be accepted, not just the first one; the
+            # listening socket is non-blocking, so we know we're done when accept() says so.
+            while True:
+               # When SSL is turned on, this can block waiting for the client to send an SSL handshake.
+               # Maybe consider running it in a thread, too?  (That's a lot of threading though.  And
+               # clients are more under our control than remote servers are.)
+               try:
+                  connection, address = listener.accept() # and hope it works
+               except BlockingIOError:
+                  return
+               except ssl.SSLError as e:
+                  # (... that's just this one client; there may be others waiting.)
+                  logging.error("SSL error in do_accept(): {}".format(e))
+                  continue
+               except Exception:
+                  kind, val, traceback = sys.exc_info()
+                  logging.error("Error in do_accept(): {}".format(val))
+                  return
+
+               logging.info("Accepted {} from {} (mask={}).".format(repr(connection), repr(address), repr(mask)))
+
+               # (See start_connection() about this.)
+               if client_nodelay:
+                  try:
+                     connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                  except OSError as e:
+                     logging.warning("Couldn't set TCP_NODELAY on {}: {}".format(repr(address), e))
+
+               if self.warn_about_connections:
+                  self.wall("A client has connected from {}.".format(repr(address)))
+
+               self.socket_wrappers[connection] = LocalClient(connection)
+               self.socket_wrappers[connection].state = 'auth'
+               self.socket_wrappers[connection].quickack = self.tcp_quickack
+               self.unauthenticated_sockets.add(connection)
+               self.sel.register(connection, selectors.EVENT_READ)
+
+               try:
+                  self.socket_wrappers[connection].add_filters(client_filters, self.filter_prototypes)
+               except FilterSpecificationError as e:
+                  self.socket_wrappers[connection].tell_err("Error setting up client filters: {}".format(str(e)))
 
          server = socket.socket()
          server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+         self.set_buffer_sizes(server)      # (accepted sockets inherit these)
 
          bind_to_host = self.cfg.get("bind_to_host", BIND_TO_HOST)
          bind_to_port = self.cfg.get("bind_to_port", BIND_TO_PORT)
@@ -913,40 +1247,53 @@ class Proxy:
          logging.info("Listening.")
 
          while True:
-            events = self.sel.select(timeout = 1)
-
-            self.LOCK.acquire()
+            # There's no need to wake up every so often: everything we wait on (including
+            # password checks and unsent output) shows up as an event, and ^C still
+            # interrupts select() by raising KeyboardInterrupt.
+            events = self.sel.select()
 
             for key, mask in events:
                s = key.fileobj
                if s == server:
                   do_accept(s, mask)
-               else:
-                  if s in self.socket_wrappers:
-                     ss = self.socket_wrappers[s]
-                  else:
-                     raise Exception("Read on unregistered socket")
-                     break
+               elif s == self.wakeup_r:
+                  try:
+                     while s.recv(4096):
+                        pass
+                  except BlockingIOError:
+                     pass
+                  self.finish_authentication()
+                  self.finish_lookups()
+               elif s in self.pending_connections:
+                  self.continue_connection(s)
+               elif mask & selectors.EVENT_READ:
+                  ss = self.socket_wrappers.get(s)
+                  if ss is None:
+                     logging.warning("Read on unregistered socket {}".format(repr(s)))
+                     continue
 
                   (lines, eof) = ss.read()
 
+                  # Nothing that happens to a line can change which state its socket is in
+                  # (clients are let in by finish_authentication()), so the handler only has
+                  # to be looked up once for all of them.
+                  handler = self.handlers[ss.state]
+                  for line in lines:
+                     handler(s, line)
+
+                  # (Whatever came in right before the connection closed -- a server's goodbye
+                  # message, say -- has been dealt with by now, so filters see it before they
+                  # hear about the disconnection.)
                   if eof:
                      self.sel.unregister(s)
+                     self.waiting_to_send.discard(s)
                      ss.handle_disconnect()
-                     for state in self.states:
-                        if s in state[0]:
-                           del state[0][state[0].index(s)]
-                     if s in self.socket_wrappers:
-                        del self.socket_wrappers[s]
+                     self.server_sockets.discard(s)
+                     self.unauthenticated_sockets.discard(s)
+                     self.client_sockets.discard(s)
+                     del self.socket_wrappers[s]
 
-                  for line in lines:
-                     for state in self.states:
-                        if s in state[0]:
-                           result = state[1](s, line)
-                           if result:
-                              break # to next line
-
-            self.LOCK.release()
+            self.drain_all()
 
       except KeyboardInterrupt:
          logging.info("Caught KeyboardInterrupt; quitting...")
@@ -965,19 +1312,29 @@ if __name__ == '__main__':
 
    proxy = Proxy(cfg)
 
+   # Being stopped (e.g. by systemd) should shut down the same way ^C does, so that plugins
+   # get their teardown() calls and can close their files properly.
+   signal.signal(signal.SIGTERM, signal.default_int_handler)
+
    pluginDir = cfg.get('plugin_directory', "plugins")
    plugin_err_fatal = cfg.get('plugin_errors_fatal', True)
 
+   # Plugins are imported all at once (any file-reading and compiling they need can overlap),
+   # then set up one by one, in the same order as always, since setup() talks to the proxy.
+   names = [P.name for P in pkgutil.iter_modules([pluginDir])]
+   with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+      imports = [(plugin, pool.submit(importlib.import_module, "{}.{}".format(pluginDir, plugin)))
+                 for plugin in names]
+
    plugins = {}
-   for P in pkgutil.iter_modules([pluginDir]):
+   for plugin, future in imports:
       try:
-         plugin = P.name
-         m = importlib.import_module("{}.{}".format(pluginDir, plugin))
+         m = future.result()
          m.setup(proxy)
          plugins[plugin] = m
          logging.info("Loaded plugin {}".format(plugin))
       except Exception:
-         kind, value, traceback = sys.exc_info()
+         kind, value, t = sys.exc_info()
          logging.error("Error loading plugin {}: {}".format(plugin, repr(value)))
          #print("-------------------- TRACEBACK:")
          #print(traceback.format_exc())
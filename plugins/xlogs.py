@@ -1,13 +1,18 @@
 import xmlwriter
 import ansi
 
-import datetime
 import time
 import logging
 
 import os
 
-open_logs = []
+open_logs = set()
+
+# Log files are written through a good-sized buffer, so that the many little
+# pieces of XML that make up a line of the log are collected in memory and
+# then go out with a single flush at the end of the line (rather than costing a
+# system call apiece.)
+LOG_BUFFER_SIZE = 65536
 
 class LoggingFilter:
     def __init__(self, connection, options):
@@ -17,6 +22,10 @@ class LoggingFilter:
         self.filehandle = None
         self.xml = None
 
+        # See timestamp().
+        self.stamp_second = None
+        self.stamp_prefix = None
+
         # This is kind of hacky, but I don't know of a good way to get
         # access to the main code's types from within the modules it
         # imports, so I can't directly see if we're getting the right
@@ -27,53 +36,79 @@ class LoggingFilter:
         except AttributeError:
             self.connection_name = "client"
 
+        # Only the date changes from one log to the next, so the rest of
+        # the filename is worked out once: the template is cut up wherever
+        # the date goes, with the connection name already filled in.
+        self.filename_parts = [part.replace('CONNECTION', self.connection_name)
+                               for part in self.filename_template.split('DATE')]
+
         # (Try to) make sure there's a directory to put logs in.
         directory = os.path.dirname(self.get_new_filename())
         if directory != "":
             os.makedirs(directory, exist_ok=True)
 
     def get_new_filename(self):
-        return self.filename_template \
-                   .replace('DATE', time.strftime("%Y-%m-%d_%H%M")) \
-                   .replace('CONNECTION', self.connection_name)
+        if len(self.filename_parts) == 1:
+            return self.filename_parts[0]
+        return time.strftime("%Y-%m-%d_%H%M").join(self.filename_parts)
+
+    def timestamp(self):
+        """The current UTC time as an ISO 8601 string, the same as
+        datetime.datetime.utcnow().isoformat() would give.  Lines tend to
+        arrive in bunches, so the part up to the seconds is only formatted
+        again when the second changes."""
+        now = time.time()
+        second = int(now)
+        microsecond = int((now - second) * 1000000)
+
+        if second != self.stamp_second:
+            self.stamp_prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self.stamp_second = second
+
+        if microsecond == 0:
+            return self.stamp_prefix
+        return "%s.%06d" % (self.stamp_prefix, microsecond)
 
     def open(self):
-        global open_logs
-
+        """Start a new log.  Returns whether that worked; if it didn't, the
+        reason has been logged and the log stays closed."""
         if self.filehandle is not None:
             raise ValueError("Cannot open log when already open")
 
         self.filename = self.get_new_filename()
 
+        # O_EXCL so that we never write over an existing log.
         try:
-            self.filehandle = open(self.filename, 'x')
+            fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
         except FileExistsError:
             logging.error("Can't create logfile {}: it exists".format(self.filename))
-            raise
+            return False
         except FileNotFoundError:
             # This happens when it can't find the directory to put it in.
-            logging.error("Can't create logfile {}: file not found (does the parent directory exist?)")
-            raise
+            logging.error("Can't create logfile {}: file not found (does the parent directory exist?)".format(self.filename))
+            return False
         except PermissionError:
-            logging.error("Can't create logfile {}: you don't have permission")
-            raise
+            logging.error("Can't create logfile {}: you don't have permission".format(self.filename))
+            return False
+        except OSError as e:
+            logging.error("Can't create logfile {}: {}".format(self.filename, e))
+            return False
 
-        self.xml = xmlwriter.XmlTagOutputter(indent='   ')
+        self.filehandle = os.fdopen(fd, 'w', buffering=LOG_BUFFER_SIZE)
 
-        def addtext(text):
-            self.filehandle.write(text)
+        self.xml = xmlwriter.XmlTagOutputter(indent='   ')
 
-        self.xml.write_callback = addtext
+        # (The XmlTagOutputter's own buffer would keep the whole log in memory; the file
+        # object does our buffering instead.)
+        self.xml.write_callback = self.filehandle.write
         self.xml.buffer = False
 
         self.xml.open_tag("log")
 
-        if self not in open_logs:
-            open_logs.append(self)
+        open_logs.add(self)
+        return True
 
     def close(self):
-        global open_logs
-
         if self.filehandle is None:
             raise ValueError("Cannot close log when already closed")
 
@@ -82,22 +117,24 @@ class LoggingFilter:
         self.filehandle = None
         self.xml = None
 
-        while self in open_logs:
-            open_logs.remove(self)
+        open_logs.discard(self)
 
     def from_server(self, line):
-        if self.filehandle is None:
-            self.open()
+        # The log is opened when the server connects (see server_connect()), so if it
+        # isn't open now, it couldn't be.
+        if self.xml is None:
+            return line
 
         passthrough = line
+        text = line.as_str()
 
-        self.xml.open_tag("line", {'date': datetime.datetime.utcnow().isoformat()})
+        self.xml.open_tag("line", {'date': self.timestamp()})
 
         try:
             # We replace '\r' and '\n' because the raw line as sent from the server
             # may / will have some kind of trailing newline, and we don't want that
             # in the logs -- the lines are already separated for us as it is.
-            line = ansi.parse_ANSI(line.as_str().replace('\r','').replace('\n',''))
+            texts, attrs = ansi.parse_ANSI_soa(text.replace('\r','').replace('\n',''))
 
         except ansi.ANSIParsingError as e:
             logging.warning("Error while trying to parse ANSI colors: {}".format(str(e)))
@@ -107,33 +144,14 @@ class LoggingFilter:
             # the ANSI codes), and repr() does that.
             #
             # ... still, this might possibly be not the best solution.
-            line = [repr(line.as_str())[1:-1]]
-
-        pending_text = None
-        pending_colors = None
-
-        for chunk in line:
-            if type(chunk) is dict:
-                if pending_colors is not None and pending_text is not None:
-                    self.xml.inline_tag("text", pending_colors, pending_text)
-                    pending_text = None
-
-                pending_colors = chunk
-
-            elif type(chunk) is str:
-                if pending_text is None:
-                    pending_text = chunk
-                else:
-                    pending_text += chunk
-
-            else:
-                raise TypeError("Unexpected type in parsed line of text")
+            texts, attrs = [repr(text)[1:-1]], [{}]
 
-        if pending_text is not None:
-            if pending_colors is None:
-                pending_colors = {}
-            logging.debug("pending_colors = {}; pending_text = {}".format(repr(pending_colors), repr(pending_text)))
-            self.xml.inline_tag("text", pending_colors, pending_text)
+        # Each piece of text comes paired with its colors, so there's no need to sort out
+        # what's what.  (Pieces can be empty when the colors changed and then nothing was
+        # written in them; those are left out.)
+        for text, colors in zip(texts, attrs):
+            if text != "":
+                self.xml.inline_tag("text", colors, text)
 
         self.xml.close_tag()
         self.filehandle.flush()
@@ -147,8 +165,10 @@ class LoggingFilter:
         if connected:
             self.filename = self.get_new_filename()
             logging.info("Opening new log {}".format(self.filename))
+            # (If this doesn't work, open() says why.  Not worth taking the
+            # connection down over; this session just won't be logged.)
             self.open()
-        else:
+        elif self.filehandle is not None:
             logging.warning("Closing log {}".format(self.filename))
             self.close()
 
@@ -156,5 +176,6 @@ def setup(proxy):
     proxy.register_filter("xlogs", LoggingFilter)
 
 def teardown(proxy):
-    for log in open_logs:
+    # (A copy, since closing a log takes it out of open_logs.)
+    for log in list(open_logs):
         log.close()
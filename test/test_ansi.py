@@ -23,6 +23,12 @@ class TestANSIProcessing(unittest.TestCase):
                 ansi.parse_ANSI("\x1B[33mHello \x1B[0;45mworld\x1Bc!"),
                 [{'fg': 3}, "Hello ", {'bg': 5}, "world", {}, "!"])
 
+    def test_attributes_and_intense_colors(self):
+        self.assertEqual(
+                ansi.parse_ANSI("\x1B[1;7;93;104mLoud\x1B[2;27mQuiet"),
+                [{'bold': 1, 'inverse': 1, 'fg': 11, 'bg': 12}, "Loud",
+                 {'bold': 0, 'inverse': 0, 'fg': 11, 'bg': 12}, "Quiet"])
+
     def test_a_real_example(self):
         self.assertEqual(
                 ansi.parse_ANSI('\x1b[34m[OOC]\x1b[0m\x1b[0m Someone says, "test"\x1b[0m\x1b[0m\r\n'),
@@ -80,5 +86,38 @@ class TestANSIProcessing(unittest.TestCase):
                  {'fg': 17, 'bg': 230}, '|[554',
                  {}, ' \r\n'])
 
+    def test_bad_parameter(self):
+        with self.assertRaises(ansi.ANSIParsingError):
+            ansi.parse_ANSI("\x1b[3x;1mHello")
+
+    def test_unbounded_csi(self):
+        with self.assertRaises(ansi.ANSIParsingError):
+            ansi.parse_ANSI("Hello \x1b[31")
+
+    def test_string_command_skipped(self):
+        self.assertEqual(
+                ansi.parse_ANSI("Hello \x1b]0;window title\x1b\\world"),
+                ["Hello world"])
+
+    def test_unterminated_string_command(self):
+        self.assertEqual(
+                ansi.parse_ANSI("Hello \x1b]0;window title"),
+                ["Hello "])
+
+    def test_soa(self):
+        self.assertEqual(
+                ansi.parse_ANSI_soa("Plain \x1b[33mHello \x1b[0;45mworld\x1b[0m"),
+                (["Plain ", "Hello ", "world", ""],
+                 [{}, {'fg': 3}, {'bg': 5}, {}]))
+
+    def test_colors_are_read_only(self):
+        colors = ansi.parse_ANSI("\x1b[31mHello")[0]
+        with self.assertRaises(TypeError):
+            colors['fg'] = 2
+
+    def test_not_a_string(self):
+        with self.assertRaises(TypeError):
+            ansi.parse_ANSI(b"\x1b[31mHello")
+
 if __name__ == '__main__':
     unittest.main()
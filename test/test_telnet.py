@@ -0,0 +1,47 @@
+import unittest
+
+import proxy
+
+class TestStripTelnet(unittest.TestCase):
+    def test_plain_data(self):
+        self.assertEqual(
+                proxy.strip_telnet(b"hello world\r\n"),
+                (b"hello world\r\n", b''))
+
+    def test_escaped_iac(self):
+        self.assertEqual(
+                proxy.strip_telnet(b"a\xff\xffb"),
+                (b"a\xffb", b''))
+
+    def test_negotiation(self):
+        self.assertEqual(
+                proxy.strip_telnet(b"a\xff\xfb\x01b\xff\xfe\x18c"),
+                (b"abc", b''))
+
+    def test_two_byte_command(self):
+        self.assertEqual(
+                proxy.strip_telnet(b"go\xff\xf9 ahead"),
+                (b"go ahead", b''))
+
+    def test_truncated_command(self):
+        self.assertEqual(
+                proxy.strip_telnet(b"abc\xff"),
+                (b"abc", b'\xff'))
+        self.assertEqual(
+                proxy.strip_telnet(b"abc\xff\xfb"),
+                (b"abc", b'\xff\xfb'))
+
+    def test_split_input(self):
+        data = b"one\xff\xff two\xff\xfb\x01 three\xff\xf1 four\xff\xfd\x03"
+        whole, leftover = proxy.strip_telnet(data)
+        self.assertEqual(leftover, b'')
+
+        for split in range(len(data) + 1):
+            first, leftover = proxy.strip_telnet(data[:split])
+            second, leftover = proxy.strip_telnet(leftover + data[split:])
+            self.assertEqual(
+                    (first + second, leftover),
+                    (whole, b''))
+
+if __name__ == '__main__':
+    unittest.main()
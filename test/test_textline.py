@@ -0,0 +1,26 @@
+import unittest
+
+import proxy
+
+class TestTextLine(unittest.TestCase):
+    def test_undecodable_bytes(self):
+        line = proxy.TextLine(b"caf\xc3\xa9 \xff\xfe ok", 'utf8')
+        self.assertEqual(
+                line.as_str(),
+                "café ?(255)?(254) ok")
+        self.assertEqual(
+                line.as_bytes(),
+                b"caf\xc3\xa9 \xff\xfe ok")
+
+    def test_set_clears_cached_string(self):
+        line = proxy.TextLine("first", 'utf8')
+        self.assertEqual(line.as_str(), "first")
+
+        line.set("second")
+        self.assertEqual(line.as_str(), "second")
+
+        line.set(b"third\xff")
+        self.assertEqual(line.as_str(), "third?(255)")
+
+if __name__ == '__main__':
+    unittest.main()